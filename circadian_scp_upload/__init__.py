@@ -1,5 +1,5 @@
 from . import screener
-from .screener import Directory, File, screen_local_directory, screen_remote_directory, compare_directory_screens
+from .screener import ChecksumAlgorithm, Directory, File, screen_local_directory, screen_remote_directory, screen_remote_filesizes, screen_remote_checksums, compare_directory_screens
 
 from . import utils
 from .utils import UploadClientCallbacks, list_src_items
@@ -1,15 +1,33 @@
 from __future__ import annotations
-from typing import Any, Callable, Literal
+from typing import Any, Callable, Generator, Literal
+import concurrent.futures
+import contextlib
+import queue
 import time
-import glob
+import io
 import fabric.connection
 import fabric.transfer
 import os
-import shutil
+import shlex
+import tarfile
 import filelock
+import paramiko
 import circadian_scp_upload
 
 
+class _ChannelWriter(io.RawIOBase):
+    """Unbuffered writable file object that sends everything to an SSH channel."""
+    def __init__(self, channel: paramiko.Channel) -> None:
+        self.channel = channel
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self.channel.sendall(data)
+        return len(data)
+
+
 class RemoteConnection:
     def __init__(self, host: str, username: str, password: str) -> None:
         self.host = host
@@ -30,6 +48,197 @@ class RemoteConnection:
     def __exit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
         self.connection.close()
 
+    def __open_sftp_client(self) -> paramiko.SFTPClient:
+        """Open a new SFTP session on the SSH connection for parallel transfers."""
+
+        # a larger channel window than paramiko's default of 2 MiB allows more
+        # unacknowledged data in flight, which matters on links with a high
+        # bandwidth-delay product
+        transport = self.connection.client.get_transport()
+        assert transport is not None, "the ssh connection is not open"
+        try:
+            sftp = paramiko.SFTPClient.from_transport(
+                transport, window_size=4 * 1024 * 1024, max_packet_size=32 * 1024
+            )
+        except paramiko.ChannelException as e:
+            raise Exception(
+                "the remote server refused to open another sftp session - " +
+                "maybe its `MaxSessions` limit is lower than the number of parallel " +
+                "transfers plus two, try a smaller `max_parallel_transfers`"
+            ) from e
+        assert sftp is not None, "could not open the sftp session"
+        return sftp
+
+    @staticmethod
+    def __put_file(sftp: paramiko.SFTPClient, local_path: str, remote_path: str) -> None:
+        with open(local_path, "rb") as f:
+            sftp.putfo(f, remote_path, file_size=os.fstat(f.fileno()).st_size)
+
+    def put_files(
+        self,
+        paths: list[tuple[str, str]],
+        max_parallel_transfers: int = 4,
+    ) -> Generator[tuple[str, str], None, None]:
+        """Upload multiple files over parallel SFTP sessions that share this SSH
+        connection, so that the round trips of one file overlap with the transfer
+        of the others. `paths` is a list of `(local_path, remote_path)` pairs.
+
+        Yields the pairs in the order in which their uploads complete. Closing
+        the generator early cancels all uploads that have not started yet."""
+
+        session_count = max(1, min(max_parallel_transfers, len(paths)))
+        sftp_clients: queue.Queue[paramiko.SFTPClient] = queue.Queue()
+
+        def _put(local_path: str, remote_path: str) -> None:
+            sftp = sftp_clients.get()
+            try:
+                self.__put_file(sftp, local_path, remote_path)
+            finally:
+                sftp_clients.put(sftp)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=session_count)
+        try:
+            # the sessions are opened inside the `try`, so if opening one of them
+            # fails, the ones already opened are closed and do not count against
+            # the `MaxSessions` limit for the rest of the connection
+            for _ in range(session_count):
+                sftp_clients.put(self.__open_sftp_client())
+            futures = {executor.submit(_put, l, r): (l, r) for l, r in paths}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                yield futures[future]
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            while not sftp_clients.empty():
+                sftp_clients.get().close()
+
+    def put_files_via_tar(
+        self,
+        local_dir_path: str,
+        remote_dir_path: str,
+        relative_paths: list[str],
+    ) -> None:
+        """Upload multiple files as a single `tar` stream over one SSH channel. This
+        avoids the SFTP round trips for opening, writing, and closing every single
+        file. Missing subdirectories are created by `tar` on the remote server."""
+
+        transport = self.connection.client.get_transport()
+        assert transport is not None, "the ssh connection is not open"
+        with transport.open_session() as channel:
+            channel.exec_command(f"tar --no-same-owner -xf - -C {shlex.quote(remote_dir_path)}")
+            # `tarfile` already writes in blocks of 1 MiB, so the blocks are sent to
+            # the channel directly instead of through a buffered `ChannelFile`
+            _write_tar_stream(_ChannelWriter(channel), local_dir_path, relative_paths)
+            channel.shutdown_write()
+            exit_status = channel.recv_exit_status()
+            with channel.makefile_stderr("rb") as remote_stderr:
+                stderr = remote_stderr.read().decode(errors="replace")
+        assert exit_status == 0, f"tar upload failed with exit status {exit_status}: {stderr}"
+
+
+def _write_tar_stream(
+    fileobj: io.RawIOBase,
+    local_dir_path: str,
+    relative_paths: list[str],
+) -> None:
+    """Write the given files of a local directory to `fileobj` as a `tar` stream.
+    Symbolic links are dereferenced, because the local screen hashes the content
+    of their targets and the remote server has to end up with that content."""
+
+    with tarfile.open(fileobj=fileobj, mode="w|", bufsize=1 << 20, dereference=True) as tar:
+        for relative_path in relative_paths:
+            tar.add(
+                os.path.join(local_dir_path, *relative_path.split("/")),
+                arcname=relative_path,
+                recursive=False,
+            )
+
+
+# files of at least this size are uploaded over parallel sftp
+# sessions instead of being bundled into tar streams
+_LARGE_FILE_SIZE = 1024 * 1024
+
+# every transfer opens its own session on the ssh connection, next to the
+# memoized sftp session and the command run by the background verification;
+# OpenSSH servers allow 10 sessions per connection by default (`MaxSessions`)
+_MAX_PARALLEL_TRANSFERS = 8
+
+
+def _split_into_batches(
+    files: list[circadian_scp_upload.File],
+    max_batch_count: int = 256,
+    max_batch_size: int = 64 * 1024 * 1024,
+) -> list[list[circadian_scp_upload.File]]:
+    """Split a list of files into batches of at most `max_batch_count` files
+    and (unless a single file is larger) at most `max_batch_size` bytes."""
+
+    batches: list[list[circadian_scp_upload.File]] = []
+    current_batch: list[circadian_scp_upload.File] = []
+    current_batch_size = 0
+    for f in files:
+        if (len(current_batch) > 0) and ((len(current_batch) >= max_batch_count) or
+                                         ((current_batch_size + f.filesize) > max_batch_size)):
+            batches.append(current_batch)
+            current_batch, current_batch_size = [], 0
+        current_batch.append(f)
+        current_batch_size += f.filesize
+    if len(current_batch) > 0:
+        batches.append(current_batch)
+    return batches
+
+
+def _find_lock_files(directory_path: str) -> Generator[str, None, None]:
+    """Yield the paths of all `.do-not-touch` files in a directory and its
+    subdirectories. `os.scandir` lists every directory with a single call and
+    already knows the type of each entry, and the names are compared directly
+    instead of being matched against a glob pattern."""
+
+    # an explicit stack instead of recursion, so that deeply nested directories
+    # neither hit the recursion limit nor keep one generator per level alive
+    stack: list[str] = [directory_path]
+    while len(stack) > 0:
+        # like the glob before, directories that cannot be read or that
+        # have been removed in the meantime are skipped
+        try:
+            with os.scandir(stack.pop()) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name == ".do-not-touch":
+                yield entry.path
+
+
+def _remove_directory(directory_path: str, max_workers: int = 16) -> None:
+    """Remove a directory with all its contents like `shutil.rmtree`, but unlink
+    the files in parallel threads. Every unlink waits for a metadata update of the
+    filesystem, which takes milliseconds on network storage or spinning disks."""
+
+    # `DirEntry.path` is built in C and the entry type comes from the directory
+    # listing, so no `os.path.join` or `os.path.islink` is needed per entry
+    file_paths: list[str] = []
+    directory_paths: list[str] = []
+    stack: list[str] = [directory_path]
+    while len(stack) > 0:
+        directory_paths.append(stack.pop())
+        with os.scandir(directory_paths[-1]) as entries:
+            for entry in entries:
+                # symlinks to directories are not followed but unlinked like files
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    file_paths.append(entry.path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(os.remove, file_paths):
+            pass
+
+    # every directory is listed before its subdirectories
+    for d in reversed(directory_paths):
+        os.rmdir(d)
+
 
 class DailyTransferClient:
     def __init__(
@@ -41,6 +250,10 @@ class DailyTransferClient:
         variant: Literal["directories", "files"],
         callbacks: circadian_scp_upload.UploadClientCallbacks = circadian_scp_upload.
         UploadClientCallbacks(),
+        checksum_algorithm: circadian_scp_upload.ChecksumAlgorithm = "md5",
+        max_parallel_transfers: int = 4,
+        use_checksum_cache: bool = False,
+        verify_after_upload: bool = True,
     ) -> None:
         self.src_path = src_path.rstrip("/")
         self.dst_path = dst_path.rstrip("/")
@@ -51,6 +264,56 @@ class DailyTransferClient:
         ), f'remote "{self.dst_path}" is not a directory'
         self.variant = variant
         self.callbacks = callbacks
+        self.checksum_algorithm: circadian_scp_upload.ChecksumAlgorithm = checksum_algorithm
+        assert 1 <= max_parallel_transfers <= _MAX_PARALLEL_TRANSFERS, (
+            f"max_parallel_transfers must be between 1 and {_MAX_PARALLEL_TRANSFERS}"
+        )
+        self.max_parallel_transfers = max_parallel_transfers
+        self.use_checksum_cache = use_checksum_cache
+        self.verify_after_upload = verify_after_upload
+
+    def __transfer_files(
+        self,
+        src_dir_path: str,
+        dst_dir_path: str,
+        files: set[circadian_scp_upload.File],
+        on_uploaded: Callable[[list[circadian_scp_upload.File]], bool],
+    ) -> bool:
+        """Upload the given files of `src_dir_path` to `dst_dir_path`. Small files
+        are sent in batches of tar streams, so their per-file overhead vanishes;
+        large files are sent over parallel sftp sessions to use more than one
+        stream. `on_uploaded` is called with every chunk of completed files and
+        returns true if the upload should be aborted.
+
+        Returns true if the upload has been aborted."""
+
+        small_files = sorted([f for f in files if f.filesize < _LARGE_FILE_SIZE])
+        large_files = sorted([f for f in files if f.filesize >= _LARGE_FILE_SIZE])
+
+        for batch in _split_into_batches(small_files):
+            self.remote_connection.put_files_via_tar(
+                src_dir_path, dst_dir_path, [f.relative_path for f in batch]
+            )
+            if on_uploaded(batch):
+                return True
+
+        if len(large_files) > 0:
+            local_paths = {
+                os.path.join(src_dir_path, *f.relative_path.split("/")): f
+                for f in large_files
+            }
+            with contextlib.closing(
+                self.remote_connection.put_files(
+                    [(local_path, f"{dst_dir_path}/{f.relative_path}")
+                     for local_path, f in local_paths.items()],
+                    max_parallel_transfers=self.max_parallel_transfers,
+                )
+            ) as uploads:
+                for local_path, _ in uploads:
+                    if on_uploaded([local_paths[local_path]]):
+                        return True
+
+        return False
 
     def __upload_directory(
         self, dir_name: str
@@ -79,14 +342,27 @@ class DailyTransferClient:
         )
 
         log_info(f"screening local directory")
-        local_directory = circadian_scp_upload.screen_local_directory(src_dir_path)
+        local_directory = circadian_scp_upload.screen_local_directory(
+            src_dir_path,
+            algorithm=self.checksum_algorithm,
+            use_checksum_cache=self.use_checksum_cache,
+        )
 
-        log_info("possibly creating remote directory")
-        self.remote_connection.connection.run(f"mkdir -p {dst_dir_path}")
+        # create the remote directory and all its subdirectories in as few round
+        # trips as possible without exceeding the maximum length of a command
+        log_info("possibly creating remote directory and all subdirectories")
+        for quoted_paths in circadian_scp_upload.utils.split_into_quoted_chunks(
+            [dst_dir_path] +
+            [f"{dst_dir_path}/{sd}" for sd in sorted(local_directory.get_subdirectories())]
+        ):
+            self.remote_connection.connection.run(f"mkdir -p -- {quoted_paths}", hide="both")
 
         log_info(f"screening remote directory")
         remote_directory = circadian_scp_upload.screen_remote_directory(
-            dst_dir_path, self.remote_connection.connection
+            dst_dir_path,
+            self.remote_connection.connection,
+            algorithm=self.checksum_algorithm,
+            reference_directory=local_directory,
         )
 
         log_info(f"comparing local and remote directory")
@@ -100,7 +376,7 @@ class DailyTransferClient:
         if len(files_not_in_sync) == 0:
             log_info("directories are in sync")
             if self.remove_files_after_upload:
-                shutil.rmtree(src_dir_path)
+                _remove_directory(src_dir_path)
                 log_info("finished removing source")
             else:
                 log_info("skipped removal of source")
@@ -108,25 +384,21 @@ class DailyTransferClient:
             return "successful"
 
         # quit if no src files are found
-        if len(files_in_sync.union(files_not_in_sync)) == 0:
+        if len(local_directory.files) == 0:
             log_info("directory is empty")
             if self.remove_files_after_upload:
-                shutil.rmtree(src_dir_path)
+                _remove_directory(src_dir_path)
                 log_info("finished removing source")
             else:
                 log_info("skipped removal of source")
             return "no files found"
 
-        # create all subdirectories on the remote server
-        log_info("possibly creating all remote subdirectories")
-        self.remote_connection.connection.run(
-            f"mkdir -p " +
-            (" ".join([f"{dst_dir_path}/{p}" for p in local_directory.get_subdirectories()]))
-        )
+        # logging progress; the uploaded files are only counted
+        # instead of being moved between the two sets
+        uploaded_count = len(files_in_sync)
 
-        # logging progress
         def _log_progress() -> None:
-            c, t = len(files_in_sync), len(local_directory.files)
+            c, t = uploaded_count, len(local_directory.files)
             fraction, finished = c / t, c == t
             log_info(
                 f"{int(fraction * 100):5.1f} % " + f"({c:{len(str(t))}d}/{t})" +
@@ -138,43 +410,77 @@ class DailyTransferClient:
         # upload every file that is missing in the remote
         # meta but present in the local directory
         last_log_time = time.time()
-        for f in sorted(list(files_not_in_sync)):
-            self.remote_connection.transfer_process.put(
-                os.path.join(src_dir_path, *f.relative_path.split("/")),
-                f"{dst_dir_path}/{f.relative_path}",
-            )
-            files_not_in_sync.remove(f)
-            files_in_sync.add(f)
 
-            if ((time.time() - last_log_time) > 60) or (len(files_not_in_sync) == 0):
+        def _mark_as_uploaded(files: list[circadian_scp_upload.File]) -> bool:
+            """Returns true if the upload should be aborted."""
+            nonlocal last_log_time, uploaded_count
+            uploaded_count += len(files)
+            finished = uploaded_count == len(local_directory.files)
+            if ((time.time() - last_log_time) > 60) or finished:
                 _log_progress()
                 last_log_time = time.time()
-                if self.callbacks.should_abort_upload():
-                    return "aborted"
+                return self.callbacks.should_abort_upload()
+            return False
+
+        # the checksums of the uploaded files are verified in a background
+        # thread batch by batch, so the verification of one batch overlaps
+        # with the transfer of the next one and the freshly written files are
+        # still in the remote page cache; only the newly uploaded files are
+        # hashed, so the cost scales with the transferred files
+        def _verify(files: list[circadian_scp_upload.File]) -> list[circadian_scp_upload.File]:
+            """Returns the files whose remote checksum does not match."""
+            remote_checksums = circadian_scp_upload.screen_remote_checksums(
+                dst_dir_path,
+                self.remote_connection.connection,
+                [f.relative_path for f in files],
+                algorithm=self.checksum_algorithm,
+            )
+            return [f for f in files if remote_checksums.get(f.relative_path) != f.checksum]
 
-        # compute remote checksum again
-        remote_directory = circadian_scp_upload.screen_remote_directory(
-            dst_dir_path, self.remote_connection.connection
-        )
-        updated_files_in_sync, updated_files_not_in_sync = circadian_scp_upload.compare_directory_screens(
-            local_directory, remote_directory
-        )
-        if len(updated_files_not_in_sync) > 0:
+        verifier = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        verifications: list[concurrent.futures.Future[list[circadian_scp_upload.File]]] = []
+
+        def _on_uploaded(files: list[circadian_scp_upload.File]) -> bool:
+            if self.verify_after_upload:
+                verifications.append(verifier.submit(_verify, files))
+            return _mark_as_uploaded(files)
+
+        try:
+            if self.__transfer_files(src_dir_path, dst_dir_path, files_not_in_sync, _on_uploaded):
+                return "aborted"
+
+            corrupted_files = [f for v in verifications for f in v.result()]
+        finally:
+            verifier.shutdown(wait=True, cancel_futures=True)
+
+        if len(corrupted_files) > 0:
             log_error(
-                f"upload is not complete, some files were not uploaded - maybe they have been added to "
-                + f"the local directory during the upload: {updated_files_not_in_sync}"
+                "upload is not complete, the remote checksums of some files do not match - " +
+                f"maybe they have been modified during the upload: {sorted(corrupted_files)}"
             )
             return "failed"
-        if files_in_sync != updated_files_in_sync:
+
+        # the files that were in sync before the upload have been verified
+        # by the first remote screening, and all uploaded files have been
+        # verified above; the sizes of all files are compared once more to
+        # detect files that have been removed from the remote in the meantime
+        remote_filesizes = circadian_scp_upload.screen_remote_filesizes(
+            dst_dir_path, self.remote_connection.connection
+        )
+        files_with_wrong_size = [
+            f.relative_path for f in local_directory.files
+            if remote_filesizes.get(f.relative_path, -1) != f.filesize
+        ]
+        if len(files_with_wrong_size) > 0:
             log_error(
-                "upload is not complete, some files were not uploaded - maybe they have been added to"
-                + f"the local directory during the upload: {files_in_sync - updated_files_in_sync}"
+                f"upload is not complete, some files are missing in the remote or have a wrong " +
+                f"size - maybe they have been modified during the upload: {files_with_wrong_size}"
             )
             return "failed"
 
         # only remove src if configured and checksums match
         if self.remove_files_after_upload:
-            shutil.rmtree(src_dir_path)
+            _remove_directory(src_dir_path)
             log_info("finished removing source")
         else:
             log_info("skipped removal of source")
@@ -189,12 +495,21 @@ class DailyTransferClient:
     ) -> Literal["successful", "failed", "aborted"]:
 
         self.callbacks.log_info(f"screening local directory")
-        local_directory = circadian_scp_upload.screen_local_directory(self.src_path, max_depth=1)
+        local_directory = circadian_scp_upload.screen_local_directory(
+            self.src_path,
+            max_depth=1,
+            algorithm=self.checksum_algorithm,
+            use_checksum_cache=self.use_checksum_cache,
+        )
         local_directory.filter_by_filenames(considered_filenames)
 
         self.callbacks.log_info(f"screening remote directory")
         remote_directory = circadian_scp_upload.screen_remote_directory(
-            self.dst_path, self.remote_connection.connection, max_depth=1
+            self.dst_path,
+            self.remote_connection.connection,
+            max_depth=1,
+            algorithm=self.checksum_algorithm,
+            reference_directory=local_directory,
         )
 
         self.callbacks.log_info(f"comparing local and remote directory")
@@ -205,34 +520,51 @@ class DailyTransferClient:
             f"found {len(files_in_sync)} synced files and {len(files_not_in_sync)} unsynced files"
         )
 
-        if self.remove_files_after_upload:
-            self.callbacks.log_info("removing files that are in sync")
-            for f in files_in_sync:
-                os.remove(os.path.join(self.src_path, f.relative_path))
+        # the local files are removed in background threads, so that their
+        # removal overlaps with the upload of the next files
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as remover:
+            removals: list[concurrent.futures.Future[None]] = []
 
-        twin_lock = circadian_scp_upload.utils.TwinFileLock(
-            self.src_path,
-            self.dst_path,
-            self.remote_connection.connection,
-            log_info=self.callbacks.log_info
-        )
-        twin_lock.aquire()
+            def _remove_local_files(files: list[circadian_scp_upload.File]) -> None:
+                for f in files:
+                    removals.append(
+                        remover.submit(os.remove, os.path.join(self.src_path, f.relative_path))
+                    )
 
-        # upload every file that is missing in the remote
-        # meta but present in the local directory
-        for f in sorted(list(files_not_in_sync)):
-            self.callbacks.log_info(f"uploading {f.relative_path}")
-            self.remote_connection.transfer_process.put(
-                os.path.join(self.src_path, f.relative_path),
-                f"{self.dst_path}/{f.relative_path}",
-            )
             if self.remove_files_after_upload:
-                self.callbacks.log_info(f"removing local {f.relative_path}")
-                os.remove(os.path.join(self.src_path, f.relative_path))
-
-            if self.callbacks.should_abort_upload():
+                self.callbacks.log_info("removing files that are in sync")
+                _remove_local_files(sorted(files_in_sync))
+
+            twin_lock = circadian_scp_upload.utils.TwinFileLock(
+                self.src_path,
+                self.dst_path,
+                self.remote_connection.connection,
+                log_info=self.callbacks.log_info
+            )
+            twin_lock.aquire()
+
+            # upload every file that is missing in the remote
+            # meta but present in the local directory
+            self.callbacks.log_info(f"uploading {len(files_not_in_sync)} files")
+
+            def _mark_as_uploaded(files: list[circadian_scp_upload.File]) -> bool:
+                """Returns true if the upload should be aborted."""
+                for f in files:
+                    self.callbacks.log_info(f"uploaded {f.relative_path}")
+                    if self.remove_files_after_upload:
+                        self.callbacks.log_info(f"removing local {f.relative_path}")
+                        _remove_local_files([f])
+                return self.callbacks.should_abort_upload()
+
+            if self.__transfer_files(
+                self.src_path, self.dst_path, files_not_in_sync, _mark_as_uploaded
+            ):
                 return "aborted"
 
+            # raise the first error of any removal before releasing the lock
+            for removal in removals:
+                removal.result()
+
         twin_lock.release()
 
         return "successful"
@@ -243,9 +575,7 @@ class DailyTransferClient:
         that another upload process is currently running on that source
         directory."""
 
-        for do_not_touch_filepath in glob.glob(
-            os.path.join(self.src_path, "**", ".do-not-touch"), recursive=True
-        ) + glob.glob(os.path.join(self.src_path, ".do-not-touch")):
+        for do_not_touch_filepath in _find_lock_files(self.src_path):
             if filelock.FileLock(do_not_touch_filepath).is_locked:
                 raise Exception(
                     f"path is used by another upload process: " +
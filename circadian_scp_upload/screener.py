@@ -1,20 +1,43 @@
 from __future__ import annotations
+import concurrent.futures
+import dataclasses
 import hashlib
+import mmap
+import operator
 import os
-from typing import Optional
+import re
+import shlex
+import sys
+from typing import Callable, Literal, Optional
 import fabric.connection
 import invoke
 import pydantic
+import circadian_scp_upload.utils
 
+# all of these are supported by Python's `hashlib` and have a matching command
+# in the GNU coreutils. `hashlib` uses the OpenSSL implementations, so `sha256`
+# runs on the SHA extensions of modern x86 CPUs (Intel Ice Lake, AMD Zen and newer);
+# `blake2b` is faster than `md5` on 64 bit CPUs without these extensions
+ChecksumAlgorithm = Literal["md5", "sha1", "sha256", "sha512", "blake2b"]
+_CHECKSUM_COMMANDS: dict[ChecksumAlgorithm, str] = {
+    "md5": "md5sum",
+    "sha1": "sha1sum",
+    "sha256": "sha256sum",
+    "sha512": "sha512sum",
+    "blake2b": "b2sum",
+}
 
-class Directory(pydantic.BaseModel):
-    files: list[File] = pydantic.Field(..., description="Files in the directory")
+
+@dataclasses.dataclass
+class Directory:
+    files: list[File]  # files in the directory
 
     def get_subdirectories(self) -> set[str]:
+        # same as `File.subdirectory` but inlined, since this runs for every file
         subdirs: set[str] = set()
         for file in self.files:
-            subdir = file.subdirectory()
-            if subdir is not None:
+            subdir, separator, _ = file.relative_path.rpartition("/")
+            if separator == "/":
                 subdirs.add(subdir)
 
         # sorting alphabetically will also put the parent directories first
@@ -24,26 +47,19 @@ class Directory(pydantic.BaseModel):
         self.files = [file for file in self.files if file.relative_path in relevant_filenames]
 
 
-class File(pydantic.BaseModel):
-    filesize: int = pydantic.Field(..., description="Size of the file in bytes")
-    md5sum: str = pydantic.Field(..., description="MD5 checksum of the file")
-    relative_path: str = pydantic.Field(
-        ..., description="Path of the file relative to the root directory"
-    )
+# not a pydantic model because the screens create and hash one instance per file;
+# `__eq__` and `__hash__` over all three fields are generated by the dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
+class File:
+    filesize: int  # size of the file in bytes
+    checksum: str  # hex digest of the used `ChecksumAlgorithm`
+    relative_path: str  # path of the file relative to the root directory
 
-    @pydantic.model_validator(mode="after")
-    def _validate(self) -> File:
+    def __post_init__(self) -> None:
         if self.relative_path.startswith("./"):
             raise ValueError("relative_path should not start with './'")
         if self.relative_path.startswith("/"):
             raise ValueError("relative_path should not start with '/'")
-        return self
-
-    def __eq__(self, other: object) -> bool:
-        if not isinstance(other, File):
-            return False
-        return ((self.filesize == other.filesize) and (self.md5sum == other.md5sum) and
-                (self.relative_path == other.relative_path))
 
     def __lt__(self, other: object) -> bool:
         if not isinstance(other, File):
@@ -51,85 +67,358 @@ class File(pydantic.BaseModel):
         return self.relative_path < other.relative_path
 
     def __str__(self) -> str:
-        return f"{self.relative_path} S{self.filesize} #{self.md5sum}"
-
-    def __hash__(self) -> int:
-        return hash((self.relative_path, self.filesize, self.md5sum))
+        return f"{self.relative_path} S{self.filesize} #{self.checksum}"
 
     def subdirectory(self) -> Optional[str]:
-        file_depth = self.relative_path.count("/")
-        # depth of 1 means that the file is in the root directory
-        if file_depth == 1:
-            return None
-        else:
-            return "/".join((self.relative_path.split("/")[:-1]))
+        # no "/" means that the file is in the root directory
+        subdir, separator, _ = self.relative_path.rpartition("/")
+        return subdir if (separator == "/") else None
+
+
+class _LineWriter:
+    """Writable text stream that calls `on_line` for every complete line. It
+    is passed as the `out_stream` of a remote command, so the output can be
+    parsed while the command is still running."""
+    def __init__(self, on_line: Callable[[str], None]) -> None:
+        self.on_line = on_line
+        self.incomplete_line = ""
+
+    def write(self, data: str) -> None:
+        lines = (self.incomplete_line + data).split("\n")
+        self.incomplete_line = lines.pop()
+        for line in lines:
+            self.on_line(line)
+
+    def flush(self) -> None:
+        pass
+
+
+def _parse_checksum_line(line: str) -> tuple[str, str]:
+    """Split a line of e.g. `md5sum` into the checksum and the path. The
+    checksum tools prefix the line with a backslash and escape the path if
+    it contains a backslash or a line break."""
+
+    checksum, _, path = line.partition("  ")
+    assert len(path) > 0, f"Unexpected line: {line}"
+    if checksum.startswith("\\"):
+        checksum = checksum[1 :]
+        path = re.sub(r"\\(.)", lambda m: {"n": "\n", "r": "\r"}.get(m.group(1), m.group(1)), path)
+    return checksum, path
 
 
 def screen_remote_directory(
     root_directory: str,
     remote_connection: fabric.connection.Connection,
     max_depth: Optional[int] = None,
+    algorithm: ChecksumAlgorithm = "md5",
+    reference_directory: Optional[Directory] = None,
 ) -> Directory:
-    """Only works on Linux distributions using GNU utilities. This is the case for all major distributions (Debian, RHEL, Arch, etc.)."""
+    """Only works on Linux distributions using GNU utilities. This is the case for all major distributions (Debian, RHEL, Arch, etc.).
+
+    With a `reference_directory` (usually the screen of the local directory), only
+    the remote files that also exist in the reference with the same size are hashed
+    and returned. All other remote files cannot be in sync with the reference anyway."""
+
+    if reference_directory is not None:
+        remote_filesizes = screen_remote_filesizes(root_directory, remote_connection, max_depth)
+        remote_checksums = screen_remote_checksums(
+            root_directory,
+            remote_connection,
+            [
+                f.relative_path for f in reference_directory.files
+                if remote_filesizes.get(f.relative_path) == f.filesize
+            ],
+            algorithm,
+        )
+        remote_files = [
+            File(filesize=remote_filesizes[p], checksum=c, relative_path=p)
+            for p, c in remote_checksums.items()
+        ]
+        remote_files.sort(key=operator.attrgetter("relative_path"))
+        return Directory(files=remote_files)
+
+    # the sizes of all files are listed by a single `find` process, and the
+    # checksums are computed by one process (e.g. `md5sum`) per cpu core with 64
+    # files each instead of spawning a shell, `stat`, and `md5sum` for every
+    # single file; `stdbuf -oL` makes every process write whole lines, so
+    # the output of the parallel processes is not interleaved
+    find_command = f"find . -maxdepth {100 if (max_depth is None) else max_depth} -type f"
+    command = (
+        f"cd {shlex.quote(root_directory)} && {find_command} -printf '%s %p\\n' && " +
+        f"echo '--- checksums ---' && {find_command} -print0 | " +
+        f"xargs -0 -r -n 64 -P \"$(nproc)\" stdbuf -oL {_CHECKSUM_COMMANDS[algorithm]} && echo '--- done ---'"
+    )
+
+    # the output is parsed line by line while the command is still running,
+    # so the parsing overlaps with the hashing on the remote server
+    filesizes: dict[str, int] = {}
+    files: list[File] = []
+    section: Literal["sizes", "checksums", "done"] = "sizes"
+
+    def _parse_line(line: str) -> None:
+        nonlocal section
+        if line == "--- checksums ---":
+            section = "checksums"
+        elif line == "--- done ---":
+            section = "done"
+        elif section == "sizes":
+            filesize, _, path = line.partition(" ")
+            filesizes[path[2 :]] = int(filesize)
+        elif section == "checksums":
+            checksum, path = _parse_checksum_line(line)
+            relative_path = path[2 :]
+            if relative_path in [".do-not-touch", "upload-meta.json"]:
+                return
+            # files that have been created between the two `find` calls are ignored
+            if relative_path in filesizes:
+                files.append(
+                    File(
+                        filesize=filesizes[relative_path],
+                        checksum=checksum,
+                        relative_path=relative_path
+                    )
+                )
+
+    result: Optional[invoke.runners.Result] = remote_connection.run(
+        command, hide="stderr", out_stream=_LineWriter(_parse_line)
+    )
+    assert result is not None, "Failed to list files"
+    assert result.ok, f"Failed to list files: {result.stderr}"
+    assert section == "done", "Command did not finish"
+
+    # sorting by the key directly avoids calling `File.__lt__` for every comparison
+    files.sort(key=operator.attrgetter("relative_path"))
+    return Directory(files=files)
+
+
+def screen_remote_filesizes(
+    root_directory: str,
+    remote_connection: fabric.connection.Connection,
+    max_depth: Optional[int] = None,
+) -> dict[str, int]:
+    """Returns the size of every file in the remote directory by its relative
+    path. This is much cheaper than `screen_remote_directory` because no file
+    has to be read. Only works on Linux distributions using GNU utilities."""
 
     command = (
-        f"cd {root_directory} && find . -maxdepth " +
-        f"{100 if (max_depth is None) else max_depth} -type f -exec sh -c " +
-        "'echo \"$(stat -c %s {})  $(md5sum {})\"' \\; && echo '--- done ---'"
+        f"cd {shlex.quote(root_directory)} && " +
+        f"find . -maxdepth {100 if (max_depth is None) else max_depth} -type f -printf '%s %p\\n' && "
+        + "echo '--- done ---'"
+    )
+    filesizes: dict[str, int] = {}
+    finished = False
+
+    def _parse_line(line: str) -> None:
+        nonlocal finished
+        if line == "--- done ---":
+            finished = True
+            return
+        filesize, _, path = line.partition(" ")
+        if path[2 :] not in [".do-not-touch", "upload-meta.json"]:
+            filesizes[path[2 :]] = int(filesize)
+
+    result: Optional[invoke.runners.Result] = remote_connection.run(
+        command, hide="stderr", out_stream=_LineWriter(_parse_line)
     )
-    result: Optional[invoke.runners.Result] = remote_connection.run(command, hide="both")
     assert result is not None, "Failed to list files"
     assert result.ok, f"Failed to list files: {result.stderr}"
-    stdout: str = result.stdout.strip(" \t\n")
+    assert finished, "Command did not finish"
+    return filesizes
+
+
+def screen_remote_checksums(
+    root_directory: str,
+    remote_connection: fabric.connection.Connection,
+    relative_paths: list[str],
+    algorithm: ChecksumAlgorithm = "md5",
+) -> dict[str, str]:
+    """Returns the checksum of each of the given files in the remote directory
+    by its relative path. Files that do not exist are left out. Only works on
+    Linux distributions using GNU utilities."""
 
-    lines = stdout.split("\n")
-    assert lines[-1] == "--- done ---", "Command did not finish"
-    files: set[File] = set()
-    for line in lines[:-1]:
-        splitted = line.split("  ")
-        assert len(splitted) == 3, f"Unexpected line: {line}"
-        filesize = int(splitted[0])
-        md5sum = splitted[1]
-        relative_path = splitted[2][2 :]
-        if relative_path not in [".do-not-touch", "upload-meta.json"]:
-            files.add(File(filesize=filesize, md5sum=md5sum, relative_path=relative_path))
+    checksums: dict[str, str] = {}
+    finished = False
 
-    return Directory(files=sorted(list(files)))
+    def _parse_line(line: str) -> None:
+        nonlocal finished
+        if line == "--- done ---":
+            finished = True
+            return
+        checksum, path = _parse_checksum_line(line)
+        checksums[path] = checksum
+
+    for quoted_paths in circadian_scp_upload.utils.split_into_quoted_chunks(relative_paths):
+        # a missing file makes `xargs` fail but the checksums of all
+        # other files are still printed, hence the `;`
+        command = (
+            f"cd {shlex.quote(root_directory)} && {{ printf '%s\\0' {quoted_paths} | " +
+            f"xargs -0 -r -n 64 -P \"$(nproc)\" stdbuf -oL {_CHECKSUM_COMMANDS[algorithm]} -- ; echo '--- done ---'; }}"
+        )
+        finished = False
+        result: Optional[invoke.runners.Result] = remote_connection.run(
+            command, hide="stderr", warn=True, out_stream=_LineWriter(_parse_line)
+        )
+        assert result is not None, "Failed to compute checksums"
+        assert finished, f"Failed to compute checksums: {result.stderr}"
+    return checksums
 
 
 def _get_recursive_files(root_directory: str, max_depth: Optional[int] = None) -> set[str]:
     paths: set[str] = set()
-    if (max_depth is None) or (max_depth > 0):
-        for f in os.listdir(root_directory):
-            path = os.path.join(root_directory, f)
-            if os.path.isfile(path):
-                paths.add(path)
-            elif os.path.isdir(path):
-                paths.update(
-                    _get_recursive_files(path, None if (max_depth is None) else (max_depth - 1))
-                )
+
+    # the directories are walked with an explicit stack instead of recursion;
+    # `os.scandir` gets the file type from the directory listing itself, so
+    # there is no additional `stat` syscall per entry
+    stack: list[tuple[str, Optional[int]]] = [(root_directory, max_depth)]
+    while len(stack) > 0:
+        directory, depth = stack.pop()
+        if (depth is not None) and (depth <= 0):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    paths.add(entry.path)
+                elif entry.is_dir():
+                    stack.append((entry.path, None if (depth is None) else (depth - 1)))
     return paths
 
 
+def _get_file_checksum(
+    path: str,
+    algorithm: ChecksumAlgorithm = "md5",
+    filesize: Optional[int] = None,
+) -> str:
+    """Compute the checksum of a file. Files larger than 1 MiB are memory-mapped,
+    so the hasher reads directly from the page cache without copying the file
+    into the Python heap. Smaller files or files that cannot be mapped (e.g. when
+    the virtual address space is too small) are streamed in chunks, so that the
+    memory usage does not grow with the size of the file. On Python 3.11 and newer,
+    `hashlib.file_digest` does the streaming in C with a reused read buffer; on
+    older versions, the chunks are read into a single reused buffer as well.
+
+    If the caller already knows the `filesize`, it is used to decide whether
+    to memory-map the file instead of running another `fstat`."""
+
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        if filesize is None:
+            filesize = os.fstat(f.fileno()).st_size
+        if filesize > (1 << 20):
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # let the kernel read ahead aggressively (only on unix)
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(mm)
+                return hasher.hexdigest()
+            except (OSError, OverflowError, ValueError):
+                pass
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(f, algorithm).hexdigest()
+        # reading into one preallocated buffer avoids allocating a new
+        # bytes object of 1 MiB for every chunk
+        buffer = bytearray(1 << 20)
+        view = memoryview(buffer)
+        while (size := f.readinto(buffer)) > 0:
+            hasher.update(view[: size])
+    return hasher.hexdigest()
+
+
+# name of the file in which `screen_local_directory` caches the checksums
+# of a directory; it is never part of the screened files itself
+CHECKSUM_CACHE_FILENAME = ".checksum-cache.json"
+
+
+class _ChecksumCache(pydantic.BaseModel):
+    algorithm: str
+    files: dict[str, tuple[int, int, str]] = pydantic.Field(
+        ..., description="Maps relative paths to (filesize, mtime in ns, checksum)"
+    )
+
+
+def _load_checksum_cache(path: str,
+                         algorithm: ChecksumAlgorithm) -> dict[str, tuple[int, int, str]]:
+    try:
+        with open(path, "r") as f:
+            cache = _ChecksumCache.model_validate_json(f.read())
+    except (OSError, pydantic.ValidationError):
+        return {}
+    return cache.files if (cache.algorithm == algorithm) else {}
+
+
+def _dump_checksum_cache(
+    path: str, algorithm: ChecksumAlgorithm, files: dict[str, tuple[int, int, str]]
+) -> None:
+    # write to a temporary file first and rename it, so an interrupted
+    # write never leaves a corrupt cache behind
+    with open(path + ".tmp", "w") as f:
+        f.write(_ChecksumCache(algorithm=algorithm, files=files).model_dump_json())
+    os.replace(path + ".tmp", path)
+
+
 def screen_local_directory(
     root_directory: str,
     max_depth: Optional[int] = None,
+    algorithm: ChecksumAlgorithm = "md5",
+    use_checksum_cache: bool = False,
 ) -> Directory:
-    """Only works on Linux distributions using GNU utilities. This is the case for all major distributions (Debian, RHEL, Arch, etc.)."""
+    """Only works on Linux distributions using GNU utilities. This is the case for all major distributions (Debian, RHEL, Arch, etc.).
+
+    With `use_checksum_cache`, the checksums are stored in a file named
+    `CHECKSUM_CACHE_FILENAME` in the root directory. Files whose size and
+    modification time did not change since the last screening are not hashed again."""
 
     absolute_paths: set[str] = _get_recursive_files(root_directory, max_depth)
-    files: set[File] = set()
+    cache_path = os.path.join(root_directory, CHECKSUM_CACHE_FILENAME)
+    cache = _load_checksum_cache(cache_path, algorithm) if use_checksum_cache else {}
 
+    # the excluded files are filtered out before the paths are submitted to
+    # the thread pool, so no task is scheduled for them
+    excluded_paths = {
+        ".do-not-touch",
+        "upload-meta.json",
+        CHECKSUM_CACHE_FILENAME,
+        CHECKSUM_CACHE_FILENAME + ".tmp",
+    }
+    paths: list[str] = []
+    relative_paths: list[str] = []
     for path in absolute_paths:
         assert path.startswith(root_directory), f"This should not happen"
 
-        bytesize = os.path.getsize(path)
-        md5sum = hashlib.md5(open(path, 'rb').read()).hexdigest()
-        relative_path = path[len(root_directory) + 1 :].replace("\\", "/")
-        if relative_path not in [".do-not-touch", "upload-meta.json"]:
-            files.add(File(filesize=bytesize, md5sum=md5sum, relative_path=relative_path))
+        # only the platform's separator is replaced, because on linux a
+        # backslash is a valid character of a file name
+        relative_path = path[len(root_directory) + 1 :].replace(os.sep, "/")
+        if relative_path not in excluded_paths:
+            paths.append(path)
+            relative_paths.append(relative_path)
+
+    def _screen_file(path: str, relative_path: str) -> tuple[File, int]:
+        stat = os.stat(path)
+        cached = cache.get(relative_path)
+        if (cached is not None) and (cached[0] == stat.st_size) and (cached[1] == stat.st_mtime_ns):
+            checksum = cached[2]
+        else:
+            checksum = _get_file_checksum(path, algorithm, filesize=stat.st_size)
+        return File(
+            filesize=stat.st_size, checksum=checksum, relative_path=relative_path
+        ), stat.st_mtime_ns
+
+    # hashlib releases the GIL while hashing, so the files can be hashed in
+    # parallel threads; the pool is capped to not thrash the disk queue
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+        results = list(executor.map(_screen_file, paths, relative_paths))
 
-    return Directory(files=sorted(list(files)))
+    if use_checksum_cache:
+        _dump_checksum_cache(
+            cache_path,
+            algorithm,
+            {f.relative_path: (f.filesize, mtime_ns, f.checksum)
+             for f, mtime_ns in results},
+        )
+
+    files = [f for f, _ in results]
+    files.sort(key=operator.attrgetter("relative_path"))
+    return Directory(files=files)
 
 
 def compare_directory_screens(
@@ -142,10 +431,15 @@ def compare_directory_screens(
         A tuple of two sets (1. files that are in sync, 2. files that are not in sync)
     """
 
-    src_files = set(src_dir.files)
-    dst_files = set(dst_dir.files)
-
-    in_sync = src_files.intersection(dst_files)
-    not_in_sync = src_files - dst_files
+    # a single pass over the source files with one lookup by path each,
+    # instead of hashing all files of both directories into sets
+    dst_files = {f.relative_path: f for f in dst_dir.files}
+    in_sync: set[File] = set()
+    not_in_sync: set[File] = set()
+    for f in src_dir.files:
+        if dst_files.get(f.relative_path) == f:
+            in_sync.add(f)
+        else:
+            not_in_sync.add(f)
 
     return in_sync, not_in_sync
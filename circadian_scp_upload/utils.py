@@ -1,14 +1,52 @@
 from __future__ import annotations
-from typing import Callable, Literal, Optional
+from typing import Callable, Iterator, Literal, NamedTuple, Optional, Union
 import os
 import re
+import shlex
+import collections
 import datetime
+import functools
 import pydantic
-import tum_esm_utils
 import fabric.connection
 
 
-def _filename_is_ambiguous_for_dated_regex(regex: str, filename: str) -> bool:
+class _CompiledDatedRegex(NamedTuple):
+    """A dated regex with the date placeholders substituted and compiled."""
+
+    pattern: re.Pattern[str]
+    trimmed_pattern: re.Pattern[str]
+    group_indices: tuple[int, int, int]  # indices of the year, month, and day groups
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_dated_regex(dated_regex: str) -> _CompiledDatedRegex:
+    """Substitutes the placeholders `%Y`/`%m`/`%d` of a dated regex with capture
+    groups and compiles the result, so that this work is not repeated for every
+    file or directory name. The result is cached, so callers that pass the plain
+    dated regex string do not compile it again either."""
+
+    keys = sorted(["%Y", "%m", "%d"], key=lambda x: dated_regex.index(x))
+    group_indices = (keys.index("%Y"), keys.index("%m"), keys.index("%d"))
+
+    regex = dated_regex
+    for old, new in {
+        "%Y": r"(\d{4})",
+        "%m": r"(\d{2})",
+        "%d": r"(\d{2})",
+    }.items():
+        regex = regex.replace(old, new)
+
+    trimmed_regex = regex[regex.index("("): regex.rindex(")") + 1]
+    trimmed_regex = trimmed_regex.replace("(", "").replace(")", "")
+
+    return _CompiledDatedRegex(
+        pattern=re.compile(regex),
+        trimmed_pattern=re.compile(trimmed_regex),
+        group_indices=group_indices,
+    )
+
+
+def _filename_is_ambiguous_for_dated_regex(trimmed_pattern: re.Pattern[str], filename: str) -> bool:
     """Returns true if the filename matches the dated regex more than once.
 
     This happens when this filename could have been produced on more than one
@@ -16,63 +54,88 @@ def _filename_is_ambiguous_for_dated_regex(regex: str, filename: str) -> bool:
     `^.*%Y%m%d.*$`, the filename `log-2020111111.txt` is ambiguous because
     it could have been produced on 2020-11-11 or 2011-11-11."""
 
-    substrings = ([filename[0 : i] for i in range(1, len(filename))] +
-                  [filename[i :] for i in range(1, len(filename))] + [filename])
-    trimmed_regex = regex[regex.index("("): regex.rindex(")") + 1]
-    trimmed_regex = trimmed_regex.replace("(", "").replace(")", "")
+    # all prefixes and suffixes of the filename are scanned for matches; the
+    # trimmed pattern starts and ends with a digit, so a scan from a non-digit
+    # or up to a non-digit finds the same matches as the one from the next or
+    # up to the previous digit and is skipped; since nothing outside of a match
+    # is looked at either, `pos`/`endpos` can be used instead of slicing
+    def _matches() -> Iterator[str]:
+        if "|" in trimmed_pattern.pattern:
+            # an alternation may start or end with anything
+            for end in range(1, len(filename) + 1):
+                yield from trimmed_pattern.findall(filename, 0, end)
+            for start in range(1, len(filename)):
+                yield from trimmed_pattern.findall(filename[start :])
+            return
+        digit_indices = [i for i, c in enumerate(filename) if c.isdigit()]
+        for i in digit_indices:
+            yield from trimmed_pattern.findall(filename, 0, i + 1)
+        for i in digit_indices:
+            yield from trimmed_pattern.findall(filename, i)
 
-    matches: list[str] = []
+    # stop as soon as a second distinct match has been found
+    first_match: Optional[str] = None
+    for match in _matches():
+        assert isinstance(match, str)
+        if first_match is None:
+            first_match = match
+        elif match != first_match:
+            return True
+    return False
 
-    for substring in substrings:
-        new_matches = re.findall(trimmed_regex, substring)
-        assert isinstance(new_matches, list)
-        assert all(isinstance(m, str) for m in new_matches)
-        matches += new_matches
 
-    return len(set(matches)) > 1
+def _get_latest_date() -> datetime.date:
+    """Returns the latest date that may be uploaded. Only dates after at
+    least 1 hour of the following day has passed are considered."""
+
+    now = datetime.datetime.now()
+    return ((now - datetime.timedelta(days=1)) if (now.hour > 0) else
+            (now - datetime.timedelta(days=2))).date()
 
 
 def _file_or_dir_name_to_date(
     file_or_dir_name: str,
-    dated_regex: str,
+    dated_regex: Union[str, _CompiledDatedRegex],
+    latest_date: Optional[datetime.date] = None,
 ) -> Optional[datetime.date]:
     """Converts a string to a date based on a dated regex.
 
     Sample input for `string`: "2021-01-01"
-    Sample input for `dated_regex`: "%Y-%m-%d" """
+    Sample input for `dated_regex`: "%Y-%m-%d"
 
-    # only consider dates after at least 1
-    # hour of the following day has passed
-    now = datetime.datetime.now()
-    latest_date = ((now - datetime.timedelta(days=1)) if (now.hour > 0) else
-                   (now - datetime.timedelta(days=2))).date()
+    When converting many names, pass `latest_date` (see `_get_latest_date`)
+    so that the current time is only read once."""
 
-    keys = list(sorted(["%Y", "%m", "%d"], key=lambda x: dated_regex.index(x)))
+    if latest_date is None:
+        latest_date = _get_latest_date()
 
-    regex = dated_regex
-    for old, new in {
-        "%Y": r"(\d{4})",
-        "%m": r"(\d{2})",
-        "%d": r"(\d{2})",
-    }.items():
-        regex = regex.replace(old, new)
+    if isinstance(dated_regex, str):
+        dated_regex = _compile_dated_regex(dated_regex)
 
-    if _filename_is_ambiguous_for_dated_regex(regex, file_or_dir_name):
+    if _filename_is_ambiguous_for_dated_regex(dated_regex.trimmed_pattern, file_or_dir_name):
         raise ValueError()
 
-    matches = re.findall(regex, file_or_dir_name)
-    if len(matches) == 0:
+    # `search` stops at the first match instead of collecting all of them; a
+    # second search after its end is cheap because the pattern is anchored
+    first_match = dated_regex.pattern.search(file_or_dir_name)
+    if first_match is None:
         return None
-    assert len(matches) == 1
-    match = matches[0]
-    assert isinstance(match, tuple)
+    assert dated_regex.pattern.search(file_or_dir_name, first_match.end()) is None
+    match = first_match.groups()
     assert len(match) == 3
+    # a name can match a branch of a top-level alternation that has no date
+    # groups (e.g. `^%Y%m%d\.txt|^notes.*$`); such names have no date
+    date_groups = [match[i] for i in dated_regex.group_indices]
+    if None in date_groups:
+        return None
+    # the groups are fixed-width digits, so they are converted directly
+    # instead of formatting them into a string for the slower `strptime`
+    year, month, day = (int(g) for g in date_groups)
     try:
-        date = datetime.datetime.strptime(f"{match[0]}-{match[1]}-{match[2]}",
-                                          "-".join(keys)).date()
-        return date if (date <= latest_date) else None
+        date = datetime.date(year, month, day)
     except ValueError:
         return None
+    return date if (date <= latest_date) else None
 
 
 def list_src_items(
@@ -80,22 +143,27 @@ def list_src_items(
     variant: Literal["directories", "files"],
     dated_regex: str,
 ) -> list[str]:
-    max_date = (datetime.datetime.now() - datetime.timedelta(hours=25)).date()
-    all_items = tum_esm_utils.files.list_directory(
-        src_path,
-        include_directories=(variant == "directories"),
-        include_files=(variant == "files"),
-        include_links=False,
-    )
+    # `os.scandir` gets the type of every entry from the directory listing,
+    # so there is no `stat` syscall per entry; symbolic links are skipped
+    all_items: list[str] = []
+    with os.scandir(src_path) as entries:
+        for entry in entries:
+            if variant == "directories":
+                if entry.is_dir(follow_symlinks=False):
+                    all_items.append(entry.name)
+            elif entry.is_file(follow_symlinks=False):
+                all_items.append(entry.name)
+    compiled_dated_regex = _compile_dated_regex(dated_regex)
+    latest_date = _get_latest_date()
     ambiguous_items: list[str] = []
     considered_items: list[str] = []
     for item in all_items:
         try:
-            date = _file_or_dir_name_to_date(item, dated_regex)
+            date = _file_or_dir_name_to_date(item, compiled_dated_regex, latest_date)
         except ValueError:
             ambiguous_items.append(item)
             continue
-        if (date is not None) and (date <= max_date):
+        if date is not None:
             considered_items.append(item)
 
     if len(ambiguous_items) > 0:
@@ -108,6 +176,26 @@ def list_src_items(
     return sorted(considered_items)
 
 
+_DATED_REGEX_TOKENS = re.compile(r"%[Ymd]?|[()]")
+
+
+def split_into_quoted_chunks(paths: list[str]) -> list[str]:
+    """Quote the given paths for a shell command and join them into chunks.
+
+    The paths are part of the command, and a single command may not be longer
+    than 128 KiB on Linux, so the paths are split into chunks of at most 64 KiB."""
+
+    chunks: list[list[str]] = []
+    chunk_length = 0
+    for quoted_path in [shlex.quote(p) for p in paths]:
+        if (len(chunks) == 0) or ((chunk_length + len(quoted_path)) > 65536):
+            chunks.append([])
+            chunk_length = 0
+        chunks[-1].append(quoted_path)
+        chunk_length += len(quoted_path) + 1
+    return [" ".join(chunk) for chunk in chunks]
+
+
 class UploadClientCallbacks(pydantic.BaseModel):
     """A collection of callbacks passed to the upload client."""
 
@@ -122,13 +210,18 @@ class UploadClientCallbacks(pydantic.BaseModel):
     @pydantic.field_validator("dated_regex", mode="before")
     @classmethod
     def _validate_dated_regex(cls, v: str) -> str:
+        # the placeholders and special characters are tallied in a single scan
+        counts = collections.Counter(_DATED_REGEX_TOKENS.findall(v))
         checks: list[tuple[bool, str]] = [
-            ("%Y" in v, "string must contain `%Y`"),
-            ("%m" in v, "string must contain `%m`"),
-            ("%d" in v, "string must contain `%d`"),
-            (v.count("%") == 3, "string must contain exactly 3 `%` characters"),
-            ("(" not in v, "string must not contain `(`"),
-            (")" not in v, "string must not contain `)`"),
+            (counts["%Y"] > 0, "string must contain `%Y`"),
+            (counts["%m"] > 0, "string must contain `%m`"),
+            (counts["%d"] > 0, "string must contain `%d`"),
+            (
+                sum(counts[t] for t in ["%", "%Y", "%m", "%d"]) == 3,
+                "string must contain exactly 3 `%` characters",
+            ),
+            (counts["("] == 0, "string must not contain `(`"),
+            (counts[")"] == 0, "string must not contain `)`"),
             (v.startswith("^"), "string must start with `^`"),
             (v.endswith("$"), "string must end with `$`"),
         ]
@@ -172,14 +265,21 @@ class TwinFileLock:
             f.write("locked by circadian_scp_upload")
         if self.log_info is not None:
             self.log_info(f'acquiring lock on remote server at "{self.dst_filepath}"')
-        self.remote_connection.run(f"touch {self.dst_filepath}")
+        # using the sftp session instead of `touch`/`rm` saves
+        # spawning a remote shell for each of these operations
+        self.remote_connection.sftp().open(self.dst_filepath, "w").close()
 
     def release(self) -> None:
         if self.log_info is not None:
             self.log_info(f'releasing lock on remote server at "{self.dst_filepath}"')
-        self.remote_connection.run(f"rm -rf {self.dst_filepath}")
+        try:
+            self.remote_connection.sftp().remove(self.dst_filepath)
+        except FileNotFoundError:
+            pass
 
         if self.log_info is not None:
             self.log_info(f'releasing lock on local machine at "{self.src_filepath}"')
-        if os.path.isfile(self.src_filepath):
+        try:
             os.remove(self.src_filepath)
+        except FileNotFoundError:
+            pass
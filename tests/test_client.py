@@ -0,0 +1,103 @@
+import io
+import os
+import pathlib
+import tarfile
+import pytest
+
+import circadian_scp_upload
+from circadian_scp_upload.client import (
+    _find_lock_files,
+    _remove_directory,
+    _split_into_batches,
+    _write_tar_stream,
+)
+from . import utils
+
+
+class _BytesWriter(io.RawIOBase):
+    def __init__(self) -> None:
+        self.buffer = io.BytesIO()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: object) -> int:
+        assert isinstance(data, (bytes, bytearray, memoryview))
+        return self.buffer.write(data)
+
+
+@pytest.mark.order(2)
+def test_write_tar_stream_dereferences_symlinks(tmp_path: pathlib.Path) -> None:
+    local_root = str(tmp_path / "local")
+    utils.write_file(os.path.join(local_root, "sub", "file.txt"), b"file content")
+    utils.write_file(str(tmp_path / "outside" / "target.txt"), b"target content")
+    os.symlink(str(tmp_path / "outside" / "target.txt"), os.path.join(local_root, "link.txt"))
+
+    writer = _BytesWriter()
+    _write_tar_stream(writer, local_root, ["sub/file.txt", "link.txt"])
+
+    writer.buffer.seek(0)
+    with tarfile.open(fileobj=writer.buffer, mode="r") as tar:
+        members = {m.name: m for m in tar.getmembers()}
+        assert set(members.keys()) == {"sub/file.txt", "link.txt"}
+        assert all(m.isfile() for m in members.values())
+        link_content = tar.extractfile(members["link.txt"])
+        assert link_content is not None
+        assert link_content.read() == b"target content"
+
+
+@pytest.mark.order(2)
+def test_find_lock_files_skips_unreadable_directories(tmp_path: pathlib.Path) -> None:
+    utils.write_file(str(tmp_path / "file.txt"), b"not a directory")
+    assert list(_find_lock_files(str(tmp_path / "missing"))) == []
+    assert list(_find_lock_files(str(tmp_path / "file.txt"))) == []
+
+
+@pytest.mark.order(2)
+def test_find_lock_files(tmp_path: pathlib.Path) -> None:
+    root = str(tmp_path / "root")
+    lock_paths = [
+        os.path.join(root, ".do-not-touch"),
+        os.path.join(root, "sub", ".do-not-touch"),
+        os.path.join(root, "sub", "deeper", ".do-not-touch"),
+        os.path.join(root, ".hidden", ".do-not-touch"),
+    ]
+    for path in lock_paths:
+        utils.write_file(path, b"")
+    utils.write_file(os.path.join(root, "sub", "not-a-lock.txt"), b"")
+    utils.write_file(str(tmp_path / "outside" / ".do-not-touch"), b"")
+    os.symlink(str(tmp_path / "outside"), os.path.join(root, "link"))
+
+    # symlinked directories are not followed
+    assert sorted(_find_lock_files(root)) == sorted(lock_paths)
+
+
+@pytest.mark.order(2)
+def test_remove_directory(tmp_path: pathlib.Path) -> None:
+    root = str(tmp_path / "root")
+    for relative_path in ["a.txt", ".hidden.txt", "sub/b.txt", "sub/deeper/c.txt"]:
+        utils.write_file(os.path.join(root, *relative_path.split("/")), b"content")
+    os.makedirs(os.path.join(root, "empty", "dir"))
+    utils.write_file(str(tmp_path / "target" / "kept.txt"), b"kept")
+    os.symlink(str(tmp_path / "target"), os.path.join(root, "sub", "link"))
+    os.symlink(str(tmp_path / "target" / "kept.txt"), os.path.join(root, "file-link.txt"))
+
+    _remove_directory(root, max_workers=2)
+
+    # symlinks are unlinked and their targets survive
+    assert not os.path.lexists(root)
+    assert os.listdir(str(tmp_path)) == ["target"]
+    assert os.listdir(str(tmp_path / "target")) == ["kept.txt"]
+
+
+@pytest.mark.order(2)
+def test_split_into_batches() -> None:
+    files = [
+        circadian_scp_upload.File(filesize=s, checksum="a", relative_path=f"{i}.txt")
+        for i, s in enumerate([10, 10, 10, 10, 10, 50, 10, 100, 10])
+    ]
+    batches = _split_into_batches(files, max_batch_count=3, max_batch_size=40)
+    batch_sizes = [[f.filesize for f in b] for b in batches]
+    assert batch_sizes == [[10, 10, 10], [10, 10], [50], [10], [100], [10]]
+    assert [f for b in batches for f in b] == files
+    assert _split_into_batches([]) == []
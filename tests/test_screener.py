@@ -0,0 +1,164 @@
+from typing import Dict, List
+import hashlib
+import json
+import os
+import pathlib
+import invoke
+import pytest
+
+import circadian_scp_upload
+from . import utils
+
+
+@pytest.mark.order(2)
+def test_screen_local_directory(tmp_path: pathlib.Path) -> None:
+    root_directory = str(tmp_path)
+    contents: Dict[str, bytes] = {
+        "empty.txt": b"",
+        "small.txt": b"some content",
+        "large.bin": os.urandom(3 * 1024 * 1024 + 17),
+        "sub/nested.txt": b"nested content",
+        "sub/deeper/nested.txt": b"deeper content",
+    }
+    for relative_path, content in contents.items():
+        utils.write_file(os.path.join(root_directory, *relative_path.split("/")), content)
+    utils.write_file(os.path.join(root_directory, ".do-not-touch"), b"locked")
+
+    directory = circadian_scp_upload.screen_local_directory(root_directory)
+    assert [f.relative_path for f in directory.files] == sorted(contents.keys())
+    for f in directory.files:
+        assert f.filesize == len(contents[f.relative_path])
+        assert f.checksum == hashlib.md5(contents[f.relative_path]).hexdigest()
+
+    directory = circadian_scp_upload.screen_local_directory(root_directory, max_depth=1)
+    assert [f.relative_path for f in directory.files] == ["empty.txt", "large.bin", "small.txt"]
+
+
+@pytest.mark.order(2)
+def test_screen_local_directory_checksum_algorithm(tmp_path: pathlib.Path) -> None:
+    utils.write_file(os.path.join(str(tmp_path), "file.txt"), b"some content")
+    algorithms: List[circadian_scp_upload.ChecksumAlgorithm] = [
+        "md5", "sha1", "sha256", "sha512", "blake2b"
+    ]
+    for algorithm in algorithms:
+        directory = circadian_scp_upload.screen_local_directory(str(tmp_path), algorithm=algorithm)
+        assert directory.files[0].checksum == hashlib.new(algorithm, b"some content").hexdigest()
+
+
+@pytest.mark.order(2)
+def test_screen_remote_directory_matches_local(tmp_path: pathlib.Path) -> None:
+    root_directory = str(tmp_path / "root dir")
+    for relative_path in [
+        "a.txt", "two  spaces.txt", "back\\slash.txt", "sub/$(echo x).txt", "sub/deep er/c.txt"
+    ]:
+        utils.write_file(os.path.join(root_directory, *relative_path.split("/")), os.urandom(100))
+
+    # the remote screening only runs shell commands, so a local context works as well
+    context = invoke.Context(invoke.Config(overrides={"run": {"in_stream": False}}))
+    remote_directory = circadian_scp_upload.screen_remote_directory(root_directory, context)
+    local_directory = circadian_scp_upload.screen_local_directory(root_directory)
+    assert len(remote_directory.files) == 5
+    assert remote_directory == local_directory
+    remote_filesizes = circadian_scp_upload.screen_remote_filesizes(root_directory, context)
+    assert remote_filesizes == {f.relative_path: f.filesize for f in local_directory.files}
+    remote_checksums = circadian_scp_upload.screen_remote_checksums(
+        root_directory, context,
+        ["two  spaces.txt", "back\\slash.txt", "sub/deep er/c.txt", "missing.txt"]
+    )
+    assert remote_checksums == {
+        f.relative_path: f.checksum
+        for f in local_directory.files if f.relative_path in remote_checksums
+    }
+    assert len(remote_checksums) == 3
+
+
+@pytest.mark.order(2)
+def test_screen_local_directory_checksum_cache(tmp_path: pathlib.Path) -> None:
+    root_directory = str(tmp_path)
+    file_path = os.path.join(root_directory, "sub", "file.txt")
+    utils.write_file(file_path, b"some content")
+    cache_path = os.path.join(root_directory, circadian_scp_upload.screener.CHECKSUM_CACHE_FILENAME)
+
+    utils.write_file(cache_path + ".tmp", b"interrupted")
+    utils.write_file(cache_path + ".bak", b"user file")
+
+    directory = circadian_scp_upload.screen_local_directory(root_directory, use_checksum_cache=True)
+    assert [f.relative_path
+            for f in directory.files] == [".checksum-cache.json.bak", "sub/file.txt"]
+    assert os.path.isfile(cache_path)
+
+    # unchanged files are not hashed again, so a planted checksum is returned
+    with open(cache_path, "r") as f:
+        cache = json.load(f)
+    cache["files"]["sub/file.txt"][2] = "planted"
+    with open(cache_path, "w") as f:
+        json.dump(cache, f)
+    directory = circadian_scp_upload.screen_local_directory(root_directory, use_checksum_cache=True)
+    assert directory.files[1].checksum == "planted"
+
+    # a different modification time invalidates the cache entry
+    os.utime(file_path, ns=(0, 0))
+    directory = circadian_scp_upload.screen_local_directory(root_directory, use_checksum_cache=True)
+    assert directory.files[1].checksum == hashlib.md5(b"some content").hexdigest()
+
+
+@pytest.mark.order(2)
+def test_compare_directory_screens() -> None:
+    File = circadian_scp_upload.File
+    src = circadian_scp_upload.Directory(
+        files=[
+            File(filesize=1, checksum="a", relative_path="same.txt"),
+            File(filesize=1, checksum="b", relative_path="other-checksum.txt"),
+            File(filesize=2, checksum="c", relative_path="other-size.txt"),
+            File(filesize=1, checksum="d", relative_path="missing.txt"),
+        ]
+    )
+    dst = circadian_scp_upload.Directory(
+        files=[
+            File(filesize=1, checksum="a", relative_path="same.txt"),
+            File(filesize=1, checksum="x", relative_path="other-checksum.txt"),
+            File(filesize=1, checksum="c", relative_path="other-size.txt"),
+            File(filesize=1, checksum="e", relative_path="only-in-dst.txt"),
+        ]
+    )
+    in_sync, not_in_sync = circadian_scp_upload.compare_directory_screens(src, dst)
+    assert in_sync == {src.files[0]}
+    assert not_in_sync == set(src.files[1 :])
+
+
+@pytest.mark.order(2)
+def test_get_subdirectories() -> None:
+    directory = circadian_scp_upload.Directory(
+        files=[
+            circadian_scp_upload.File(filesize=1, checksum="a", relative_path=p)
+            for p in ["root.txt", "a/1.txt", "a/2.txt", "a/b/c/3.txt", "d e/4.txt"]
+        ]
+    )
+    assert directory.get_subdirectories() == {"a", "a/b/c", "d e"}
+
+
+@pytest.mark.order(2)
+def test_screen_remote_directory_with_reference(tmp_path: pathlib.Path) -> None:
+    local_root, remote_root = str(tmp_path / "local"), str(tmp_path / "remote")
+    for root, content in [(local_root, b"local content"), (remote_root, b"other content")]:
+        utils.write_file(os.path.join(root, "same.txt"), b"same content")
+        utils.write_file(os.path.join(root, "same size.txt"), content)
+        utils.write_file(
+            os.path.join(root, "other size.txt"), content * (2 if root == local_root else 1)
+        )
+    utils.write_file(os.path.join(local_root, "only local.txt"), b"local content")
+    utils.write_file(os.path.join(remote_root, "only remote.txt"), b"remote content")
+
+    # files that cannot be in sync because their size differs are not hashed
+    local_directory = circadian_scp_upload.screen_local_directory(local_root)
+    remote_directory = circadian_scp_upload.screen_remote_directory(
+        remote_root,
+        invoke.Context(invoke.Config(overrides={"run": {"in_stream": False}})),
+        reference_directory=local_directory,
+    )
+    assert [f.relative_path for f in remote_directory.files] == ["same size.txt", "same.txt"]
+    in_sync, not_in_sync = circadian_scp_upload.compare_directory_screens(
+        local_directory, remote_directory
+    )
+    assert [f.relative_path for f in in_sync] == ["same.txt"]
+    assert len(not_in_sync) == 3
@@ -1,8 +1,9 @@
 from typing import List
 import datetime
+import shlex
 import pytest
 
-from circadian_scp_upload.utils import _file_or_dir_name_to_date
+from circadian_scp_upload.utils import _file_or_dir_name_to_date, split_into_quoted_chunks
 
 
 @pytest.mark.order(2)
@@ -43,6 +44,14 @@ def test_file_or_dir_name_to_date_parsing() -> None:
         "02-03-2021", "^%m-%d-%Y$"
     ) == expected_date
 
+    # names that match a branch of an alternation without the date groups
+    assert _file_or_dir_name_to_date(
+        "20210203.txt", r"^%Y%m%d\.txt|^notes.*$"
+    ) == expected_date
+    assert _file_or_dir_name_to_date(
+        "notes.md", r"^%Y%m%d\.txt|^notes.*$"
+    ) == None
+
 
 @pytest.mark.order(2)
 def test_file_or_dir_name_to_date_ambiguity() -> None:
@@ -101,3 +110,12 @@ def test_file_or_dir_name_to_date_timing() -> None:
         assert _file_or_dir_name_to_date(
             date.strftime("%Y-%m-%d"), "^%Y-%m-%d$"
         ) == date
+
+
+@pytest.mark.order(2)
+def test_split_into_quoted_chunks() -> None:
+    paths = [f"dir {i:05d}/" + "x" * 100 for i in range(2000)]
+    chunks = split_into_quoted_chunks(paths)
+    assert len(chunks) > 1
+    assert all(len(c) <= 65536 for c in chunks)
+    assert [p for c in chunks for p in shlex.split(c)] == paths
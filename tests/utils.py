@@ -57,6 +57,13 @@ def load_credentials() -> Tuple[str, str, str]:
     return TEST_SERVER_HOST, TEST_SERVER_USERNAME, TEST_SERVER_PASSWORD
 
 
+def write_file(path: str, content: bytes) -> None:
+    """Write `content` to `path`, creating all missing parent directories."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
 def generate_tmp_directory_path() -> str:
     """Generate a path to a temporary directory that does not exist yet."""
     current_timestamp = int(time.time())